@@ -1,15 +1,142 @@
 import collections
+import functools
 import os
 import pathlib
 import shutil
+import selectors
+import signal
 import subprocess
 import sys
+import time
 
 import jinja2
 
 TEMPL_DIR = os.path.dirname(__file__)
 ResultTuple = collections.namedtuple("ResultTuple", "succ, log")
 
+MAX_OUTPUT = 1024 * 1024  # 1 MiB
+READ_CHUNK = 64 * 1024
+POLL_INTERVAL = 0.1  # Segundos entre comprobaciones de si el comando terminó.
+TRUNCATED_MSG = b"\n\n=== Salida truncada (demasiado larga) ===\n"
+
+
+@functools.lru_cache()
+def reply_templ():
+  """Devuelve la plantilla de la respuesta, cargándola solo la primera vez.
+
+  No se carga al importar el módulo porque worker.py importa este módulo
+  también para el resto de correctores.
+  """
+  jinja = jinja2.Environment(line_statement_prefix="#",
+                             line_comment_prefix="--",
+                             loader=jinja2.FileSystemLoader(TEMPL_DIR))
+  return jinja.get_template("reply-java.j2")
+
+
+def kill_group(proc):
+  """Mata el grupo de procesos de proc (lanzado con start_new_session=True).
+  """
+  try:
+    os.killpg(proc.pid, signal.SIGKILL)
+  except ProcessLookupError:
+    pass
+
+
+def run_capped(args, cwd, timeout):
+  """Ejecuta un comando guardando a lo sumo MAX_OUTPUT bytes de su salida.
+
+  El resto de la salida se lee y se descarta, para que el proceso no se
+  bloquee con el pipe lleno. Tiene la misma semántica que subprocess.run()
+  con stdout=PIPE y stderr=STDOUT: devuelve un CompletedProcess, o lanza
+  TimeoutExpired con la salida obtenida hasta el momento.
+
+  El comando se ejecuta en una sesión nueva, y su grupo de procesos se mata
+  al terminar el comando, o ante un timeout o cualquier otra excepción. Así
+  no quedan procesos hijos (p. ej. la JVM que lanza ant, o algo que dejen las
+  pruebas en segundo plano) manteniendo abierto el pipe. Si algún proceso
+  escapó del grupo y lo sigue manteniendo, se corta igualmente al vencer el
+  timeout.
+  """
+  buf = bytearray()
+  truncated = False
+  deadline = time.monotonic() + timeout
+
+  def output():
+    return bytes(buf) + (TRUNCATED_MSG if truncated else b"")
+
+  with subprocess.Popen(args, cwd=cwd, start_new_session=True,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT) as proc:
+    try:
+      with selectors.DefaultSelector() as sel:
+        fd = proc.stdout.fileno()
+        sel.register(fd, selectors.EVENT_READ)
+        exited = False
+
+        while True:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            raise subprocess.TimeoutExpired(args, timeout, output=output())
+
+          if sel.select(min(remaining, POLL_INTERVAL)):
+            chunk = os.read(fd, READ_CHUNK)
+            if not chunk:
+              break
+            room = MAX_OUTPUT - len(buf)
+            if len(chunk) > room:
+              truncated = True
+            if room > 0:
+              buf.extend(chunk[:room])
+
+          # Si el comando ya terminó, lo que quede en su grupo no debe
+          # impedir que lleguemos a EOF.
+          if not exited and proc.poll() is not None:
+            exited = True
+            kill_group(proc)
+
+      try:
+        proc.wait(timeout=max(deadline - time.monotonic(), 0))
+      except subprocess.TimeoutExpired:
+        raise subprocess.TimeoutExpired(args, timeout, output=output())
+    finally:
+      kill_group(proc)
+
+  return subprocess.CompletedProcess(args, proc.returncode, output())
+
+
+def iter_java(directory):
+  """Itera recursivamente sobre los archivos .java de un directorio.
+
+  Yields:
+    - objetos os.DirEntry.
+  """
+  pending = [directory]
+  while pending:
+    with os.scandir(pending.pop()) as entries:
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          pending.append(entry.path)
+        elif entry.name.endswith(".java"):
+          yield entry
+
+
+def link_or_copy(entry, dest_dir):
+  """Pone un archivo en dest_dir mediante un hard link o, si no se puede, una
+  copia.
+
+  Si el destino ya existe, se elimina antes: podría ser un link a otro archivo,
+  y copiar encima lo modificaría también.
+  """
+  dest = os.path.join(dest_dir, entry.name)
+  try:
+    os.unlink(dest)
+  except FileNotFoundError:
+    pass
+  try:
+    os.link(entry.path, dest)
+  except OSError:
+    shutil.copy(entry.path, dest)
+
 
 class CorregirJava:
   """Compila y corrige una entrega.
@@ -23,17 +150,17 @@ class CorregirJava:
     corr.mkdir()
     seen_alu = set()
 
-    for file in alu.glob("**/*.java"):
-      shutil.copy(file, corr)
+    for file in iter_java(alu):
+      link_or_copy(file, corr)
       seen_alu.add(file.name)
 
     # Sobrescribir skel para la corrección y, si hace falta, añadir
     # en "alu" dependencias para la compilación.
-    for file in pub.glob("**/*.java"):
-      shutil.copy(file, corr)
+    for file in iter_java(pub):
+      link_or_copy(file, corr)
       if (file.name not in seen_alu and
           not file.name.startswith("Test")):  # XXX Hackish.
-        shutil.copy(file, alu)
+        link_or_copy(file, alu)
 
     shutil.copy(pub / "build.xml", self.path)
 
@@ -45,9 +172,7 @@ class CorregirJava:
     try:
       for step in steps:
         silence = [] if step == "pruebas_basicas" else ["-q", "-S"]
-        cmd = subprocess.run(["ant", step] + silence,
-                             cwd=self.path, timeout=timeout,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        cmd = run_capped(["ant", step] + silence, self.path, timeout)
         success = (cmd.returncode == 0)
         outcomes[step] = ResultTuple(success,
                                      cmd.stdout.decode("utf-8", "replace"))
@@ -60,9 +185,5 @@ class CorregirJava:
                                    ex.stdout.decode("utf-8", "replace"))
       final_result["reject"] = True
     finally:
-      jinja = jinja2.Environment(line_statement_prefix="#",
-                                 line_comment_prefix="--",
-                                 loader=jinja2.FileSystemLoader(TEMPL_DIR))
-      templ = jinja.get_template("reply-java.j2")
-      sys.stdout.write(templ.render(final_result))
+      sys.stdout.write(reply_templ().render(final_result))
       sys.stdout.flush()